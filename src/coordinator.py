@@ -0,0 +1,441 @@
+"""
+Coordinates a scrape of the CANTUS API by several worker processes.
+
+The page space is split into shards of consecutive pages. Workers, possibly
+on different machines sharing a filesystem, claim shards through lease files,
+scrape the pages of a shard into a private work directory and commit the
+shard by exclusively creating a commit marker. Leases expire if they are not
+renewed, so that shards of a crashed worker are picked up by other workers.
+The pages of committed shards are moved to the usual `pages` directory right
+away. Finally, `merge` checks that all shards are committed and marks the
+scrape as done, so that the result is a normal scrape directory.
+
+Usage:
+
+    python coordinator.py work [num_workers] [date]
+    python coordinator.py merge [date]
+
+Workers on other machines should pass the date of the scraping session, so
+that they all use the same directory.
+"""
+import os
+import sys
+import json
+import time
+import math
+import shutil
+import socket
+import logging
+import datetime
+import multiprocessing
+from scrape import AbbotScraper, SCRAPE_DIR, MAX_PAGE_SIZE
+from helpers import mark_scrape_done, clear_scrape_done
+
+### Globals
+
+SHARD_SIZE = 25
+LEASE_TIMEOUT = 10 * 60
+
+# The maximum number of requests per second, summed over all workers
+MAX_REQUEST_RATE = 4
+
+### Helpers
+
+def write_json_atomic(filename, data):
+    """Write a JSON file by writing to a temporary file and renaming it, so
+    that other processes never see a partially written file."""
+    tmp_fn = f'{filename}.{socket.gethostname()}-{os.getpid()}.tmp'
+    with open(tmp_fn, 'w') as handle:
+        json.dump(data, handle)
+    os.replace(tmp_fn, filename)
+
+def read_json(filename):
+    with open(filename, 'r') as handle:
+        return json.load(handle)
+
+def split_pages(num_pages, shard_size=SHARD_SIZE):
+    """Split the pages 1, ..., num_pages into shards of consecutive pages
+
+    >>> split_pages(5, shard_size=2)
+    [[1, 2], [3, 4], [5, 5]]
+
+    Parameters
+    ----------
+    num_pages : int
+        The total number of pages
+    shard_size : int, optional
+        The number of pages per shard, by default SHARD_SIZE
+
+    Returns
+    -------
+    list
+        A list with the first and last page of every shard
+    """
+    num_shards = math.ceil(num_pages / shard_size)
+    return [[i * shard_size + 1, min((i + 1) * shard_size, num_pages)]
+        for i in range(num_shards)]
+
+###
+
+class ShardCoordinator:
+
+    def __init__(self, name='scrape', scrape_dir=SCRAPE_DIR,
+        date=datetime.date.today().strftime("%Y-%m-%d"),
+        lease_timeout=LEASE_TIMEOUT, max_request_rate=MAX_REQUEST_RATE,
+        worker=None):
+        """Hands out shards of pages to workers using file-based leases.
+
+        All state is stored in the directory `shards/` inside the directory of
+        the scraping session:
+
+        - `plan.json`: the page size and the first and last page of all shards
+        - `leases/shard-0000.json`: the worker holding a shard, and when the
+            lease expires
+        - `work/shard-0000-worker/`: pages scraped by a worker
+        - `committed/shard-0000.json`: marks a shard as completed, and records
+            the worker whose pages are used
+        - `workers/worker`: heartbeat files of all workers
+
+        Parameters
+        ----------
+        name : str, optional
+            A name for the scraping session, by default 'scrape'
+        scrape_dir : str, optional
+            The directory where Cantus dumps are stored, by default SCRAPE_DIR
+        date : str, optional
+            A date string used to name the output directory. This defaults to
+            today.
+        lease_timeout : float, optional
+            Number of seconds after which a lease that has not been renewed
+            expires, by default LEASE_TIMEOUT
+        max_request_rate : float, optional
+            The maximum number of requests per second summed over all
+            workers, by default MAX_REQUEST_RATE
+        worker : str or None, optional
+            Name of this worker; by default the hostname and process id
+        """
+        self.name = f'{date}-{name}'
+        self.lease_timeout = lease_timeout
+        self.max_request_rate = max_request_rate
+        if worker is None:
+            worker = f'{socket.gethostname()}-{os.getpid()}'
+        self.worker = worker
+
+        # Directories
+        self.output_dir = os.path.join(scrape_dir, self.name)
+        self.pages_dir = os.path.join(self.output_dir, 'pages')
+        self.shards_dir = os.path.join(self.output_dir, 'shards')
+        self.plan_fn = os.path.join(self.shards_dir, 'plan.json')
+        self.leases_dir = os.path.join(self.shards_dir, 'leases')
+        self.work_dir = os.path.join(self.shards_dir, 'work')
+        self.committed_dir = os.path.join(self.shards_dir, 'committed')
+        self.workers_dir = os.path.join(self.shards_dir, 'workers')
+        for directory in [self.leases_dir, self.work_dir,
+            self.committed_dir, self.workers_dir]:
+            os.makedirs(directory, exist_ok=True)
+
+    def plan(self, num_pages, page_size=MAX_PAGE_SIZE, shard_size=SHARD_SIZE):
+        """Split the page space in shards and store the plan. If a plan
+        already exists (because another worker created it), that plan is
+        returned instead.
+
+        Returns
+        -------
+        dict
+            The plan, with keys `page_size` and `shards`
+        """
+        if not os.path.exists(self.plan_fn):
+            plan = dict(page_size=page_size, shards=split_pages(num_pages, shard_size))
+            tmp_fn = f'{self.plan_fn}.{self.worker}.tmp'
+            with open(tmp_fn, 'w') as handle:
+                json.dump(plan, handle)
+            try:
+                # Linking fails if the plan exists, so the first plan wins
+                os.link(tmp_fn, self.plan_fn)
+                logging.info(f'Split {num_pages} pages into {len(plan["shards"])} shards')
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(tmp_fn)
+        return read_json(self.plan_fn)
+
+    def lease_fn(self, shard):
+        return os.path.join(self.leases_dir, f'shard-{shard:04d}.json')
+
+    def commit_fn(self, shard):
+        return os.path.join(self.committed_dir, f'shard-{shard:04d}.json')
+
+    def is_committed(self, shard):
+        return os.path.exists(self.commit_fn(shard))
+
+    def claim(self, shard):
+        """Try to claim a shard. Expired leases are reclaimed.
+
+        Returns
+        -------
+        bool
+            Whether the shard was claimed by this worker
+        """
+        lease_fn = self.lease_fn(shard)
+        if os.path.exists(lease_fn):
+            try:
+                lease = read_json(lease_fn)
+            except (FileNotFoundError, ValueError):
+                return False
+            if lease['expires'] > time.time():
+                return False
+            # Move the lease out of the way. Another worker may have reclaimed
+            # it (or its owner renewed it) after we read it, in which case we
+            # moved a fresh lease: check this and put it back.
+            stale_fn = f'{lease_fn}.{self.worker}.stale'
+            try:
+                os.rename(lease_fn, stale_fn)
+            except FileNotFoundError:
+                return False
+            try:
+                moved_lease = read_json(stale_fn)
+            except ValueError:
+                # A lease that was just created and is still being written
+                moved_lease = None
+            if moved_lease != lease or moved_lease['expires'] > time.time():
+                try:
+                    # Linking fails if yet another lease has been created
+                    os.link(stale_fn, lease_fn)
+                except FileExistsError:
+                    pass
+                os.remove(stale_fn)
+                return False
+            os.remove(stale_fn)
+            logging.warning(f'Reclaiming expired lease of shard {shard} '
+                f'held by {lease["worker"]}')
+
+        try:
+            fd = os.open(lease_fn, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as handle:
+            json.dump(self.lease(), handle)
+        return True
+
+    def lease(self):
+        return dict(worker=self.worker, expires=time.time() + self.lease_timeout)
+
+    def renew(self, shard):
+        """Renew the lease on a shard and update the heartbeat of this worker.
+
+        Returns
+        -------
+        bool
+            False if the lease was lost to another worker
+        """
+        lease_fn = self.lease_fn(shard)
+        try:
+            if read_json(lease_fn)['worker'] != self.worker:
+                return False
+        except (FileNotFoundError, ValueError):
+            return False
+        write_json_atomic(lease_fn, self.lease())
+        self.heartbeat()
+        return True
+
+    def release(self, shard):
+        """Remove the lease on a shard, if it is held by this worker"""
+        lease_fn = self.lease_fn(shard)
+        try:
+            if read_json(lease_fn)['worker'] == self.worker:
+                os.remove(lease_fn)
+        except (FileNotFoundError, ValueError):
+            pass
+
+    def heartbeat(self):
+        heartbeat_fn = os.path.join(self.workers_dir, self.worker)
+        with open(heartbeat_fn, 'w') as handle:
+            handle.write(str(time.time()))
+
+    def num_active_workers(self):
+        """The number of workers with a recent heartbeat, including this one"""
+        now = time.time()
+        workers = set([self.worker])
+        for worker in os.listdir(self.workers_dir):
+            heartbeat_fn = os.path.join(self.workers_dir, worker)
+            if now - os.path.getmtime(heartbeat_fn) < self.lease_timeout:
+                workers.add(worker)
+        return len(workers)
+
+    def request_delay(self):
+        """The delay between requests of a single worker, such that the total
+        request rate of all active workers stays below the maximum."""
+        return self.num_active_workers() / self.max_request_rate
+
+    def work_dir_of(self, shard, worker=None):
+        if worker is None:
+            worker = self.worker
+        directory = os.path.join(self.work_dir, f'shard-{shard:04d}-{worker}')
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def commit(self, shard):
+        """Commit a shard by exclusively creating its commit marker. This only
+        succeeds if this worker still holds the lease and no other worker has
+        committed the shard; otherwise the pages of this worker are 
+        discarded. The pages of a committed shard are then published to the
+        pages directory, so that the corpus can be generated while the scrape
+        is running.
+
+        Returns
+        -------
+        bool
+            Whether the shard was committed by this worker
+        """
+        work_dir = self.work_dir_of(shard)
+        if not self.renew(shard):
+            logging.warning(f'Lost the lease on shard {shard}, not committing')
+            shutil.rmtree(work_dir)
+            return False
+        # Write the marker to a temporary file and link it: linking fails if
+        # the shard was already committed, and the marker is never partial
+        commit_fn = self.commit_fn(shard)
+        tmp_fn = f'{commit_fn}.{self.worker}.tmp'
+        with open(tmp_fn, 'w') as handle:
+            json.dump(dict(worker=self.worker), handle)
+        try:
+            os.link(tmp_fn, commit_fn)
+        except FileExistsError:
+            shutil.rmtree(work_dir)
+            self.release(shard)
+            return False
+        finally:
+            os.remove(tmp_fn)
+        self.release(shard)
+        self.publish(shard)
+        return True
+
+    def publish(self, shard):
+        """Move the pages of a committed shard from the work directory of the
+        committing worker to the pages directory. Every page is moved 
+        atomically, so readers never see a partial page. Returns the number 
+        of pages moved."""
+        worker = read_json(self.commit_fn(shard))['worker']
+        shard_dir = self.work_dir_of(shard, worker=worker)
+        os.makedirs(self.pages_dir, exist_ok=True)
+        num_pages = 0
+        for page_fn in sorted(os.listdir(shard_dir)):
+            os.replace(os.path.join(shard_dir, page_fn),
+                os.path.join(self.pages_dir, page_fn))
+            num_pages += 1
+        os.rmdir(shard_dir)
+        return num_pages
+
+    def abort(self, shard):
+        """Discard the work on a shard"""
+        shutil.rmtree(self.work_dir_of(shard))
+        self.release(shard)
+
+    def work(self, scraper):
+        """Claim, scrape and commit shards until all shards are committed.
+
+        Parameters
+        ----------
+        scraper : AbbotScraper
+            The scraper used to retrieve the pages. It should scrape into the
+            directory of this scraping session.
+        """
+        clear_scrape_done(self.output_dir)
+        num_pages = math.ceil(scraper.get_num_results() / MAX_PAGE_SIZE)
+        plan = self.plan(num_pages)
+        shards = plan['shards']
+        self.heartbeat()
+        while True:
+            remaining = [i for i in range(len(shards)) if not self.is_committed(i)]
+            if len(remaining) == 0:
+                break
+            claimed = None
+            for shard in remaining:
+                if self.claim(shard):
+                    claimed = shard
+                    break
+            if claimed is None:
+                # All remaining shards are leased: wait for them to be
+                # committed or for a lease to expire
+                self.heartbeat()
+                time.sleep(min(self.lease_timeout / 10, 30))
+                continue
+            self.scrape_shard(scraper, claimed, *shards[claimed],
+                page_size=plan['page_size'])
+        logging.info(f'Worker {self.worker} finished')
+        scraper.metrics.summary()
+
+    def scrape_shard(self, scraper, shard, start_page, end_page, page_size):
+        logging.info(f'Worker {self.worker} scraping shard {shard} '
+            f'(pages {start_page}-{end_page})')
+        pages = range(start_page, end_page + 1)
+        work_dir = self.work_dir_of(shard)
+        with scraper.metrics.stage(f'shard:{shard:04d}', rows_in=len(pages)) as stage:
+            num_resources = 0
+            for page_num in pages:
+                if not self.renew(shard):
+                    logging.warning(f'Lost the lease on shard {shard}, aborting')
+                    shutil.rmtree(work_dir)
+                    return False
+                scraper.request_delay = self.request_delay()
+                page = scraper.scrape_page(page_num, page_size, pages_dir=work_dir)
+                num_resources += len(page['resources'])
+            stage['rows_out'] = num_resources
+            committed = self.commit(shard)
+            stage['committed'] = committed
+        return committed
+
+    def merge(self, cleanup=True):
+        """Move the pages of all committed shards to the pages directory.
+
+        Parameters
+        ----------
+        cleanup : bool, optional
+            Remove the shards directory after merging, by default True
+        """
+        plan = read_json(self.plan_fn)
+        missing = [i for i in range(len(plan['shards'])) if not self.is_committed(i)]
+        if len(missing) > 0:
+            raise Exception(f'Cannot merge: shards {missing} are not committed')
+
+        # Pages are published when a shard is committed, but a worker may
+        # have crashed while doing so
+        num_pages = 0
+        for shard in range(len(plan['shards'])):
+            num_pages += self.publish(shard)
+        logging.info(f'Merged {len(plan["shards"])} shards; moved {num_pages} '
+            'remaining pages')
+        mark_scrape_done(self.output_dir, start_page=1, end_page=plan['shards'][-1][1])
+        if cleanup:
+            shutil.rmtree(self.shards_dir)
+
+###
+
+def run_worker(name, date):
+    """Run a single worker; the entry point of a worker process"""
+    coordinator = ShardCoordinator(name, date=date)
+    scraper = AbbotScraper(name, date=date, worker=coordinator.worker)
+    coordinator.work(scraper)
+
+def run_workers(name, date, num_workers):
+    """Start a number of worker processes on this machine and wait for them
+    to finish. Other machines sharing the scrape directory can run workers
+    for the same scraping session at the same time."""
+    processes = []
+    for i in range(num_workers):
+        process = multiprocessing.Process(target=run_worker, args=(name, date))
+        process.start()
+        processes.append(process)
+    for process in processes:
+        process.join()
+
+if __name__ == "__main__":
+    name = 'scrape-v0.1'
+    command = sys.argv[1] if len(sys.argv) > 1 else 'work'
+    if command == 'work':
+        num_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+        date = sys.argv[3] if len(sys.argv) > 3 else datetime.date.today().strftime("%Y-%m-%d")
+        run_workers(name, date, num_workers)
+    elif command == 'merge':
+        date = sys.argv[2] if len(sys.argv) > 2 else datetime.date.today().strftime("%Y-%m-%d")
+        ShardCoordinator(name, date=date).merge()
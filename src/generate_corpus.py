@@ -6,15 +6,18 @@
 # -----------------------------------------------------------------------------
 """Generate the CantusCorpus"""
 import os
+import argparse
 import logging
 import glob
 import shutil
+import time
 import re
 import yaml
 
 import pandas as pd
 from collections import Counter
-from helpers import read_gzip_json
+from helpers import iter_page_resources, is_scrape_done
+from instrumentation import Metrics
 import numpy as np
 import datetime
 
@@ -27,7 +30,13 @@ SCRAPE_DIR = os.path.join(ROOT_DIR, 'scrape')
 DIST_DIR = os.path.join(ROOT_DIR, 'dist')
 OUTPUT_DIR = os.path.join(DIST_DIR, f'cantuscorpus-v{__version__}')
 CSV_DIR = os.path.join(OUTPUT_DIR, 'csv')
+AGGREGATES_DIR = os.path.join(CSV_DIR, 'aggregates')
 TMP_DIR = os.path.join(OUTPUT_DIR, 'tmp')
+# Metrics and profiles are not part of the released corpus
+METRICS_DIR = os.path.join(DIST_DIR, f'cantuscorpus-v{__version__}-metrics')
+
+# The scraping session from which the corpus is generated by default
+SCRAPE_NAME = '2020-07-09-scrape-v0.1'
 
 # Three types are ignored: portfolio, source_status, segment
 TYPES = [
@@ -53,6 +62,42 @@ FOREIGN_IDS = [
     'segment_id'
 ]
 
+# Aggregate tables: the columns to group the chants by, what to compute per
+# group (the number of chants, or the Volpiano coverage) and a description. 
+# Century and provenance are looked up in the source table.
+AGGREGATES = {
+    'chant_counts_by_source_genre': dict(
+        columns=['source_id', 'genre_id'],
+        measure='count',
+        description='Number of chants per source and genre'),
+    'chant_counts_by_feast_office': dict(
+        columns=['feast_id', 'office_id'],
+        measure='count',
+        description='Number of chants per feast and office'),
+    'chant_counts_by_century': dict(
+        columns=['century'],
+        measure='count',
+        description='Number of chants per century of the source'),
+    'chant_counts_by_provenance_genre': dict(
+        columns=['provenance_id', 'genre_id'],
+        measure='count',
+        description='Number of chants per provenance of the source and genre'),
+    'volpiano_coverage_by_source': dict(
+        columns=['source_id'],
+        measure='volpiano_coverage',
+        description='Number of chants per source, the number of those with a '
+            'Volpiano transcription, and their ratio'),
+}
+
+# When streaming, the number of seconds between checks for new pages, and the
+# number of seconds without new pages after which the scrape is assumed dead
+POLL_INTERVAL = 5
+STREAM_TIMEOUT = 30 * 60
+
+# String columns in which at most this fraction of the values is unique are 
+# stored as categoricals
+MAX_CATEGORY_RATIO = 0.5
+
 table_structure_fn = os.path.join(SRC_DIR, 'table_structure.yml')
 with open(table_structure_fn, 'r') as stream:
     TABLE_STRUCTURE = yaml.safe_load(stream)
@@ -84,14 +129,258 @@ def read_resources(scrape_name):
         raise Warning('No pages found!')
     resources = {}
     for page_fn in page_filenames:
-        page = read_gzip_json(page_fn)
-        resources.update(page['resources'])
+        resources.update(iter_page_resources(page_fn))
     df = pd.DataFrame(resources).T
     df.index.name = 'orig_id'
     df.sort_index(inplace=True)
     del df['id']
     return df
 
+class ResourceAccumulator(object):
+
+    def __init__(self):
+        """Collects resources page by page in a columnar format: for every
+        resource type a dictionary with a list of values per field. This 
+        avoids keeping a dictionary per resource in memory, and allows pages
+        to be processed while the scrape is still running."""
+        self.columns = {}
+        self.ids = {}
+        self.positions = {}
+        self.removed = {}
+
+    def add_resources(self, resources):
+        """Add resources from an iterable of (id, resource) pairs, such as 
+        `helpers.iter_page_resources`. Resources that were already added are
+        replaced entirely, as in `read_resources`: fields missing from the new
+        resource are cleared, and if its type changed, it is moved to the
+        table of the new type."""
+        for orig_id, resource in resources:
+            rtype = resource.get('type')
+            if rtype not in self.columns:
+                self.columns[rtype] = {}
+                self.ids[rtype] = []
+                self.removed[rtype] = set()
+            columns = self.columns[rtype]
+            ids = self.ids[rtype]
+            position = None
+            if orig_id in self.positions:
+                old_rtype, old_position = self.positions[orig_id]
+                for values in self.columns[old_rtype].values():
+                    values[old_position] = None
+                if old_rtype == rtype:
+                    position = old_position
+                else:
+                    self.removed[old_rtype].add(old_position)
+            if position is None:
+                position = len(ids)
+                ids.append(orig_id)
+                for values in columns.values():
+                    values.append(None)
+                self.positions[orig_id] = (rtype, position)
+            for field, value in resource.items():
+                if field not in columns:
+                    columns[field] = [None] * len(ids)
+                columns[field][position] = value
+
+    def __len__(self):
+        return len(self.positions)
+
+    def to_tables(self):
+        """Return a dictionary with a dataframe of resources for every type.
+        As in `read_resources`, the resources are sorted by their original
+        id, and the `id` field is dropped."""
+        tables = {}
+        for rtype, columns in self.columns.items():
+            table = pd.DataFrame(columns, index=self.ids[rtype], dtype=object)
+            removed = self.removed[rtype]
+            if len(removed) > 0:
+                # Drop resources that were moved to another type
+                keep = [i not in removed for i in range(len(table))]
+                table = table[keep]
+            table.index.name = 'orig_id'
+            table.sort_index(inplace=True)
+            if 'id' in table.columns:
+                del table['id']
+            tables[rtype] = table
+        return tables
+
+def watch_pages(pages_dir, output_dir, poll_interval=POLL_INTERVAL, 
+    timeout=STREAM_TIMEOUT):
+    """Yield the filenames of scraped pages as soon as they appear in the 
+    pages directory, until the scraping session is marked as done.
+
+    Parameters
+    ----------
+    pages_dir : str
+        The directory containing the pages
+    output_dir : str
+        The directory of the scraping session
+    poll_interval : float, optional
+        Seconds between checks for new pages, by default POLL_INTERVAL
+    timeout : float, optional
+        Raise a warning if no new pages appear for this many seconds,
+        by default STREAM_TIMEOUT
+    """
+    seen = set()
+    last_page_time = time.time()
+    while True:
+        # Check whether the scrape is done before listing the pages, so that
+        # no pages written in between are missed
+        done = is_scrape_done(output_dir)
+        pattern = os.path.join(pages_dir, '*.json.gz')
+        new_pages = sorted(set(glob.glob(pattern)) - seen)
+        for page_fn in new_pages:
+            seen.add(page_fn)
+            yield page_fn
+        if done:
+            break
+        if len(new_pages) > 0:
+            last_page_time = time.time()
+        elif time.time() - last_page_time > timeout:
+            raise Warning(f'No new pages in the last {timeout} seconds')
+        time.sleep(poll_interval)
+
+def read_resources_streaming(scrape_name, **kwargs):
+    """Read the scraped resources while the scrape is still running. Pages 
+    are decoded and accumulated as soon as they are written, and the 
+    function returns once the scraping session is marked as done. Unlike
+    `read_resources`, the resources are returned per type, so that they do
+    not have to be split up again.
+
+    Parameters
+    ----------
+    scrape_name : str
+        Name of the scraping session
+    **kwargs
+        Keyword arguments passed to `watch_pages`
+
+    Returns
+    -------
+    dict
+        A dictionary with a dataframe of resources for every type
+    """
+    logging.info('Reading out the resources while they are being scraped...')
+    output_dir = os.path.join(SCRAPE_DIR, scrape_name)
+    pages_dir = os.path.join(output_dir, 'pages')
+    os.makedirs(pages_dir, exist_ok=True)
+    accumulator = ResourceAccumulator()
+    num_pages = 0
+    for page_fn in watch_pages(pages_dir, output_dir, **kwargs):
+        accumulator.add_resources(iter_page_resources(page_fn))
+        num_pages += 1
+    if num_pages == 0:
+        raise Warning('No pages found!')
+    logging.info(f'* Read {len(accumulator)} resources from {num_pages} pages')
+    return accumulator.to_tables()
+
+def memory_usage(df):
+    """Return the memory footprint of a dataframe in bytes, including the 
+    Python objects referenced by object columns"""
+    return int(df.memory_usage(deep=True).sum())
+
+def compact_column(column, dtype=None, categorical=False):
+    """Convert a column to a memory-compact dtype.
+
+    Integer columns are downcast to the smallest (nullable) integer type, but
+    only if all values are integers. Other columns are converted to 
+    categoricals if `categorical` is True, or if they are not numeric and
+    contain few unique values.
+
+    >>> compact_column(pd.Series([1.0, 2.0, None]), dtype='int').dtype
+    Int8Dtype()
+    >>> compact_column(pd.Series(['a', 'b', 'a', 'a'])).dtype.name
+    'category'
+    >>> compact_column(pd.Series([1.0, 2.0, 3.0]), categorical=True).dtype.name
+    'category'
+
+    Parameters
+    ----------
+    column : pd.Series
+        The column
+    dtype : str or None, optional
+        The dtype from `table_structure.yml`, by default None
+    categorical : bool, optional
+        Always convert to a categorical, by default False
+
+    Returns
+    -------
+    pd.Series
+        The converted column
+    """
+    if dtype == 'int':
+        numbers = pd.to_numeric(column, errors='coerce')
+        values = numbers.dropna()
+        is_integer = (values == np.round(values)).all()
+        if numbers.notna().sum() == column.notna().sum() and is_integer:
+            downcast = pd.to_numeric(values.astype('int64'), downcast='integer')
+            nullable_dtype = downcast.dtype.name.title()
+            return numbers.astype(nullable_dtype)
+
+    if column.dtype.name == 'category':
+        return column
+    if categorical:
+        return column.astype('category')
+    if column.dtype.kind in 'biuf':
+        return column
+    if column.nunique() <= MAX_CATEGORY_RATIO * column.notna().sum():
+        return column.astype('category')
+    return column
+
+def compact_table(table, rtype, report=None):
+    """Use the dtypes listed in `table_structure.yml` to reduce the memory
+    footprint of a table; see `compact_column`. Foreign ids are always 
+    stored as categoricals; their dtype in `table_structure.yml` describes
+    the new ids, not the original ones, and is therefore ignored.
+
+    Parameters
+    ----------
+    table : pd.DataFrame
+        The table
+    rtype : str
+        The resource type of the table
+    report : dict or None, optional
+        If passed, the memory footprint before and after is stored in 
+        `report[rtype]`
+
+    Returns
+    -------
+    pd.DataFrame
+        The compacted table
+    """
+    before = memory_usage(table)
+    fields = TABLE_STRUCTURE.get(rtype, {}).get('fields', [])
+    dtypes = {field['name']: field.get('dtype') for field in fields}
+    for column in table.columns:
+        is_foreign_id = column in FOREIGN_IDS
+        dtype = None if is_foreign_id else dtypes.get(column)
+        table[column] = compact_column(table[column], 
+            dtype=dtype, categorical=is_foreign_id)
+    after = memory_usage(table)
+    logging.info(f'* Compacted table {rtype}: {before / 1024**2:.1f} MB '
+        f'-> {after / 1024**2:.1f} MB')
+    if report is not None:
+        report[rtype] = dict(before=before, after=after)
+    return table
+
+def read_table(rtype, report=None):
+    """Read a table from the CSV directory and compact it
+
+    Parameters
+    ----------
+    rtype : str
+        The resource type of the table
+    report : dict or None, optional
+        See `compact_table`
+
+    Returns
+    -------
+    pd.DataFrame
+        The table
+    """
+    table_fn = os.path.join(CSV_DIR, f'{rtype}.csv')
+    table = pd.read_csv(table_fn, index_col=0)
+    return compact_table(table, rtype, report=report)
+
 def sample_dev_resources(resources):
     types = resources['type'].unique()
     ids = []
@@ -129,6 +418,94 @@ def generate_dev_resources(resources_fn):
     df.to_csv(os.path.join(output_dir, 'dev-resources.csv'))
     return df
 
+def count_chants(chants, columns):
+    """Count the number of chants for every combination of values in the 
+    given columns. Missing values are counted as well, and are left empty.
+
+    Parameters
+    ----------
+    chants : pd.DataFrame
+        The chant table, possibly joined with other tables
+    columns : list
+        The columns to group by
+
+    Returns
+    -------
+    pd.DataFrame
+        A table with the grouping columns and a column `count`
+    """
+    # Pandas drops missing values when grouping, so temporarily replace them 
+    # by empty strings. These are written as missing values to the csv.
+    keys = chants[columns].astype(object).fillna('')
+    counts = keys.groupby(columns).size()
+    counts.name = 'count'
+    # The groups are already sorted. Sorting again could fail on columns that
+    # mix numbers and empty strings.
+    return counts.reset_index()
+
+def volpiano_coverage(chants, columns):
+    """Count the number of chants and the number of chants with a Volpiano
+    transcription for every combination of values in the given columns. 
+    Missing values are counted as well, and are left empty.
+
+    Parameters
+    ----------
+    chants : pd.DataFrame
+        The chant table, possibly joined with other tables
+    columns : list
+        The columns to group by
+
+    Returns
+    -------
+    pd.DataFrame
+        A table with the grouping columns and columns `num_chants`, 
+        `num_volpiano` and `coverage`
+    """
+    keys = chants[columns].astype(object).fillna('')
+    has_volpiano = chants['volpiano'].notna()
+    coverage = has_volpiano.groupby([keys[col] for col in columns]).agg(['size', 'sum'])
+    coverage.columns = ['num_chants', 'num_volpiano']
+    coverage['coverage'] = coverage['num_volpiano'] / coverage['num_chants']
+    return coverage.reset_index()
+
+def compute_aggregates(chant, source, century):
+    """Compute all aggregate tables listed in AGGREGATES. Chants are linked
+    to a provenance and a period through their source, and periods (such as
+    the first half of the 12th century) are rolled up to whole centuries.
+
+    Parameters
+    ----------
+    chant : pd.DataFrame
+        The chant table
+    source : pd.DataFrame
+        The source table
+    century : pd.DataFrame
+        The century table
+
+    Returns
+    -------
+    dict
+        A dictionary with a dataframe for every aggregate table
+    """
+    source_columns = source[['century_id', 'provenance_id']].astype(object)
+    centuries = century['century'].astype('Int64')
+    source_columns['century'] = source_columns['century_id'].map(centuries)
+    chants = chant.join(source_columns, on='source_id')
+    aggregates = {}
+    measures = dict(count=count_chants, volpiano_coverage=volpiano_coverage)
+    for name, props in AGGREGATES.items():
+        measure = measures[props['measure']]
+        aggregates[name] = measure(chants, props['columns'])
+    return aggregates
+
+def read_aggregates():
+    """Read all aggregate tables from the aggregates directory"""
+    aggregates = {}
+    for aggregate_fn in sorted(glob.glob(os.path.join(AGGREGATES_DIR, '*.csv'))):
+        name = os.path.basename(aggregate_fn)[:-len('.csv')]
+        aggregates[name] = pd.read_csv(aggregate_fn)
+    return aggregates
+
 ###
 
 def parse_century_name(name):
@@ -281,9 +658,11 @@ def process_table_chant(df, **kwargs):
 ###
 
 def extract_table_of_type(resources, rtype):
-    logging.info(f'Extracting type={rtype}')
     table = resources.query(f'type=="{rtype}"').copy()
+    return process_table(table, rtype)
 
+def process_table(table, rtype):
+    logging.info(f'Extracting type={rtype}')
     # Process the table: add ids, possible other columns, and sort
     processor = globals().get(f'process_table_{rtype}', process_table_default)
     table = processor(table, rtype=rtype)
@@ -305,33 +684,50 @@ def extract_table_of_type(resources, rtype):
     return table
 
 def update_foreign_ids(table, orig_ids):
+    """Replace the original ids in all foreign id columns by the new ids. The
+    columns are mapped in place, without copying the table, and are stored as
+    categoricals."""
     foreign_id_cols = [col for col in table.columns if col in FOREIGN_IDS]
-    if len(foreign_id_cols) == 0: 
-        return table
-
-    # Temporarily rename the index, as there is also an 'id' column in orig_ids
-    table.index.name = '__index'
-    table.reset_index(inplace=True)
+    new_ids = orig_ids.set_index('orig_id')['id']
     for foreign_id in foreign_id_cols:
-        table = table.merge(orig_ids, 
-            left_on=foreign_id, right_on='orig_id', how='left')
-        # Replace the foreign id by the matching 'ids' in orig_id: the new ids
-        del table[foreign_id]
-        table[foreign_id] = table['id']
-        del table['id']
-        del table['orig_id']
-    table.set_index('__index', inplace=True)
-    table.index.name = 'id'
+        table[foreign_id] = table[foreign_id].map(new_ids).astype('category')
     return table
      
-def generate_corpus(scrape_name):
-    
+def generate_corpus(scrape_name, metrics=None, stream=False):
+    """Generate all tables of the corpus from a scraping session.
+
+    Parameters
+    ----------
+    scrape_name : str
+        Name of the scraping session
+    metrics : Metrics or None, optional
+        Collects timing and memory usage of all steps. If None (the default),
+        metrics are only kept in memory.
+    stream : bool, optional
+        Read pages while the scraping session is still running; see
+        `read_resources_streaming`. By default False.
+    """
+    if metrics is None:
+        metrics = Metrics()
+
     # Step 1
-    resources = read_resources(scrape_name)
-    resources_fn = os.path.join(TMP_DIR, f'resources-{scrape_name}.csv')
-    resources.to_csv(resources_fn)
-    logging.info(f'Stored resources temporarily to {relpath(resources_fn)}')
-    resources = pd.read_csv(resources_fn, index_col=0)
+    with metrics.stage('read_resources') as stage:
+        if stream:
+            # Resources are already collected per type: no need to store
+            # them all in one table and split them up again
+            tables = read_resources_streaming(scrape_name)
+            stage['rows_out'] = sum(len(table) for table in tables.values())
+            stage['memory'] = sum(memory_usage(table) for table in tables.values())
+        else:
+            resources = read_resources(scrape_name)
+            resources_fn = os.path.join(TMP_DIR, f'resources-{scrape_name}.csv')
+            resources.to_csv(resources_fn)
+            logging.info(f'Stored resources temporarily to {relpath(resources_fn)}')
+            # Resource types and foreign ids are highly repetitive
+            categorical = {col: 'category' for col in FOREIGN_IDS + ['type']}
+            resources = pd.read_csv(resources_fn, index_col=0, dtype=categorical)
+            stage['rows_out'] = len(resources)
+            stage['memory'] = memory_usage(resources)
 
     # After extracting all resources, you can generate a subset with resources
     # of all types to speed up the development process
@@ -343,12 +739,22 @@ def generate_corpus(scrape_name):
     # Step 2
     orig_ids = {}
     for rtype in TYPES:
-        table = extract_table_of_type(resources, rtype=rtype)
-        orig_ids.update(table['orig_id'].to_dict())
-        del table['orig_id']
-        table_fn = os.path.join(CSV_DIR, f'{rtype}.csv')
-        table.to_csv(table_fn)
-        logging.info(f'* Stored table for type {rtype} to {relpath(table_fn)}')
+        if stream:
+            table = tables.pop(rtype)
+            rows_in = len(table)
+        else:
+            rows_in = len(resources)
+        with metrics.stage(f'extract:{rtype}', rows_in=rows_in) as stage:
+            if stream:
+                table = process_table(table, rtype=rtype)
+            else:
+                table = extract_table_of_type(resources, rtype=rtype)
+            orig_ids.update(table['orig_id'].to_dict())
+            del table['orig_id']
+            table_fn = os.path.join(CSV_DIR, f'{rtype}.csv')
+            table.to_csv(table_fn)
+            logging.info(f'* Stored table for type {rtype} to {relpath(table_fn)}')
+            stage['rows_out'] = len(table)
 
     # Step 4: Store original ids
     orig_ids = pd.Series(orig_ids).sort_index()
@@ -360,23 +766,44 @@ def generate_corpus(scrape_name):
     
     # Step 5: update foreign ids and reorder the columns
     logging.info('Updating foreign ids and reordering columns...')
-    orig_ids = orig_ids.reset_index()
-    for rtype in TYPES:
-        table_fn = os.path.join(CSV_DIR, f'{rtype}.csv')
-        table = pd.read_csv(table_fn, index_col=0)
-        table = update_foreign_ids(table, orig_ids)
-        if rtype in TABLE_STRUCTURE:
-            order = [field['name'] for field in TABLE_STRUCTURE[rtype]['fields'] if field['name'] != 'id']
-            assert set(table.columns) == set(order)
-            table = table[order]
-        table.to_csv(table_fn)
-
-    chant = pd.read_csv(os.path.join(CSV_DIR, 'chant.csv'), index_col=0)
-    has_volpiano = chant.volpiano.isna() == False
-    sample = chant.loc[has_volpiano, :].sample(n=2000, random_state=0).sort_index()
-    sample_fn = os.path.join(CSV_DIR, 'chant-demo-sample.csv')
-    sample.to_csv(sample_fn)
-    logging.info(f'Stored a random sample of 2000 chants to {relpath(sample_fn)}')
+    # Read the original ids back, so that they are parsed in the same way as
+    # the foreign ids in the stored tables
+    orig_ids = pd.read_csv(orig_ids_fn)
+    with metrics.stage('update_foreign_ids', rows_in=len(orig_ids)) as stage:
+        num_rows = 0
+        for rtype in TYPES:
+            table_fn = os.path.join(CSV_DIR, f'{rtype}.csv')
+            table = read_table(rtype, report=stage.setdefault('memory', {}))
+            table = update_foreign_ids(table, orig_ids)
+            if rtype in TABLE_STRUCTURE:
+                order = [field['name'] for field in TABLE_STRUCTURE[rtype]['fields'] if field['name'] != 'id']
+                assert set(table.columns) == set(order)
+                table = table[order]
+            table.to_csv(table_fn)
+            num_rows += len(table)
+        stage['rows_out'] = num_rows
+
+    with metrics.stage('sample') as stage:
+        chant = read_table('chant')
+        stage['rows_in'] = len(chant)
+        has_volpiano = chant.volpiano.isna() == False
+        sample = chant.loc[has_volpiano, :].sample(n=2000, random_state=0).sort_index()
+        sample_fn = os.path.join(CSV_DIR, 'chant-demo-sample.csv')
+        sample.to_csv(sample_fn)
+        logging.info(f'Stored a random sample of 2000 chants to {relpath(sample_fn)}')
+        stage['rows_out'] = len(sample)
+
+    with metrics.stage('aggregates', rows_in=len(chant)) as stage:
+        logging.info('Computing aggregate tables...')
+        if not os.path.exists(AGGREGATES_DIR):
+            os.makedirs(AGGREGATES_DIR)
+        aggregates = compute_aggregates(chant, read_table('source'), 
+            read_table('century'))
+        for name, aggregate in aggregates.items():
+            aggregate_fn = os.path.join(AGGREGATES_DIR, f'{name}.csv')
+            aggregate.to_csv(aggregate_fn, index=False)
+            logging.info(f'* Stored {name} to {relpath(aggregate_fn)}')
+        stage['rows_out'] = sum(len(aggregate) for aggregate in aggregates.values())
 
 ###
 
@@ -391,9 +818,24 @@ class ReadmeWriter(object):
         # Load all csv files
         self.tables = {}
         for rtype in TABLE_STRUCTURE:
-            table_fn = os.path.join(CSV_DIR, f'{rtype}.csv')
-            table = pd.read_csv(table_fn, index_col=0)
-            self.tables[rtype] = table
+            self.tables[rtype] = read_table(rtype)
+        self.aggregates = read_aggregates()
+
+    def value_counts(self, table_name, column_name):
+        """Count how often every value occurs in a column. For columns of the
+        chant table these are computed from the aggregate tables if 
+        possible; otherwise the table itself is used."""
+        if table_name == 'chant':
+            for name, props in AGGREGATES.items():
+                if props['measure'] != 'count':
+                    continue
+                if column_name in props['columns'] and name in self.aggregates:
+                    aggregate = self.aggregates[name]
+                    counts = aggregate.groupby(column_name)['count'].sum()
+                    counts.index.name = None
+                    counts.name = column_name
+                    return counts.sort_values(ascending=False, kind='mergesort')
+        return pd.value_counts(self.tables[table_name][column_name])
 
     def table_structure(self, table_name):
         """Create a Markdown table describing the structure a database table:
@@ -414,7 +856,7 @@ class ReadmeWriter(object):
                 continue
             table = self.tables[table_name]
             column_name = column['name']
-            value_counts = pd.value_counts(table[column_name])
+            value_counts = self.value_counts(table_name, column_name)
             value_descriptions = column.get('value_descriptions', {})
             title = f'#### Values of `{table_name}.{column_name}`\n'
             if 'value_description_table' in column:
@@ -477,6 +919,12 @@ class ReadmeWriter(object):
             output += self.table_structure(table_name)
         return output
 
+    def get_aggregates(self):
+        lines = []
+        for name, props in AGGREGATES.items():
+            lines.append(f'- `aggregates/{name}.csv`: {props["description"]}')
+        return '\n'.join(lines)
+
     def write_readme(self, cantus_scrape_date="?"):
         """Write the README for a release of the GregoBase Corpus using the 
         template file `readme_template.md`."""
@@ -489,7 +937,8 @@ class ReadmeWriter(object):
             'cantus_scrape_date': cantus_scrape_date,
             'corpus_date': corpus_date,
             'changelog': self.get_changelog(),
-            'tables': self.get_tables()
+            'tables': self.get_tables(),
+            'aggregates': self.get_aggregates()
         }
 
         for rtype in TABLE_STRUCTURE:
@@ -516,7 +965,20 @@ def compress_corpus():
 
 ###
  
-def main():
+def main(scrape_name=SCRAPE_NAME, profile_stage=None, stream=False):
+    """Generate the corpus, README and archive.
+
+    Parameters
+    ----------
+    scrape_name : str, optional
+        Name of the scraping session, e.g. '2020-07-09-scrape-v0.1'. By 
+        default SCRAPE_NAME.
+    profile_stage : str or None, optional
+        Name of a stage to profile using cProfile, e.g. 'extract:chant' or
+        'readme'. The profile is stored in METRICS_DIR.
+    stream : bool, optional
+        Start generating while the scrape is still running, by default False
+    """
     # Clear output_dir before starting logging to that directory
     if os.path.exists(OUTPUT_DIR):
         shutil.rmtree(OUTPUT_DIR)
@@ -525,6 +987,9 @@ def main():
         os.makedirs(CSV_DIR)
     if not os.path.exists(TMP_DIR):
         os.makedirs(TMP_DIR)
+    if os.path.exists(METRICS_DIR):
+        shutil.rmtree(METRICS_DIR)
+    os.makedirs(METRICS_DIR)
 
     # Set up logging
     log_fn = os.path.join(OUTPUT_DIR, 'corpus-generation.log')
@@ -536,14 +1001,37 @@ def main():
     logging.info(f'Start generating CantusCorpus v{__version__}')
     logging.info(f"> Output directory: '{relpath(OUTPUT_DIR)}'")
 
+    metrics_fn = os.path.join(METRICS_DIR, 'metrics.jsonl')
+    metrics = Metrics(metrics_fn, profile_stage=profile_stage)
+    logging.info(f"> Metrics: '{relpath(metrics_fn)}'")
+
     # Go
-    generate_corpus('2020-07-09-scrape-v0.1')
-    writer = ReadmeWriter()
-    writer.write_readme()
+    logging.info(f"> Scraping session: '{scrape_name}'")
+    generate_corpus(scrape_name, metrics=metrics, stream=stream)
+    with metrics.stage('readme'):
+        writer = ReadmeWriter()
+        writer.write_readme()
     shutil.rmtree(TMP_DIR)
-    compress_corpus()
+    with metrics.stage('archive'):
+        compress_corpus()
+    metrics.summary()
 
 if __name__ == '__main__':
     # import doctest
     # doctest.testmod()
-    main()
+
+    parser = argparse.ArgumentParser(description='Generate the CantusCorpus')
+    parser.add_argument('--scrape-name', default=None,
+        help=f"Name of the scraping session, e.g. '{SCRAPE_NAME}' (the default)")
+    parser.add_argument('--stream', action='store_true',
+        help='Generate the corpus while the scrape is still running; '
+            'requires --scrape-name')
+    parser.add_argument('--profile', metavar='STAGE', default=None,
+        help="Profile a stage using cProfile, e.g. 'extract:chant'")
+    args = parser.parse_args()
+    if args.stream and args.scrape_name is None:
+        # The scraper names sessions after the day it started
+        parser.error('--stream requires --scrape-name, e.g. '
+            f'{datetime.date.today().strftime("%Y-%m-%d")}-scrape-v0.1')
+    scrape_name = args.scrape_name or SCRAPE_NAME
+    main(scrape_name=scrape_name, profile_stage=args.profile, stream=args.stream)
@@ -1,13 +1,115 @@
+import os
 import json
 import gzip
 
-def write_gzip_json(filename, data):
+# Optional, faster JSON libraries. The standard library is used if they are
+# not installed.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Written to the directory of a scraping session once all pages are scraped
+SCRAPE_DONE_FN = 'done.json'
+
+# Compression level of gzipped JSON files: 1 is fastest, 9 is smallest
+COMPRESS_LEVEL = 9
+
+# Decode pages incrementally using ijson. This is slower than decoding the 
+# whole page with the selected codec, and only pays off for very large pages.
+INCREMENTAL_DECODING = False
+
+### JSON codecs
+
+def _stdlib_dumps(data):
+    return json.dumps(data).encode('utf-8')
+
+def _ujson_dumps(data):
+    return ujson.dumps(data).encode('utf-8')
+
+# Every codec is a pair of functions: one encoding to bytes, and one decoding
+# bytes. They are listed in order of preference.
+JSON_CODECS = {}
+if orjson is not None:
+    JSON_CODECS['orjson'] = (orjson.dumps, orjson.loads)
+if ujson is not None:
+    JSON_CODECS['ujson'] = (_ujson_dumps, ujson.loads)
+JSON_CODECS['json'] = (_stdlib_dumps, json.loads)
+
+_json_codec = list(JSON_CODECS.keys())[0]
+
+def set_json_codec(name):
+    """Set the JSON library used to read and write gzipped JSON files; one of
+    the keys of JSON_CODECS. By default the fastest available one is used."""
+    global _json_codec
+    if name not in JSON_CODECS:
+        raise ValueError(f'Unknown or unavailable JSON codec: {name}')
+    _json_codec = name
+
+def get_json_codec():
+    return _json_codec
+
+###
+
+def write_gzip_json(filename, data, compresslevel=None):
     """Write a gzipped JSON file"""
     # https://stackoverflow.com/questions/39450065/python-3-read-write-compressed-json-objects-from-to-gzip-file
-    with gzip.GzipFile(filename, 'w') as fout:
-        fout.write(json.dumps(data).encode('utf-8'))
+    if compresslevel is None:
+        compresslevel = COMPRESS_LEVEL
+    dumps, _ = JSON_CODECS[_json_codec]
+    with gzip.GzipFile(filename, 'w', compresslevel=compresslevel) as fout:
+        fout.write(dumps(data))
 
 def read_gzip_json(filename):
+    _, loads = JSON_CODECS[_json_codec]
     with gzip.GzipFile(filename, 'r') as fin:
-        data = json.loads(fin.read().decode('utf-8'))
+        data = loads(fin.read())
     return data
+
+def iter_page_resources(filename, incremental=None):
+    """Iterate over the resources in a gzipped page, yielding pairs of ids
+    and resources. By default the whole page is decoded using the selected
+    codec. If `incremental` is True, the page is decoded incrementally using
+    ijson, so that the page is never fully held in memory.
+
+    Parameters
+    ----------
+    filename : str
+        The gzipped page
+    incremental : bool or None, optional
+        Use ijson, by default INCREMENTAL_DECODING
+    """
+    if incremental is None:
+        incremental = INCREMENTAL_DECODING
+    if incremental:
+        if ijson is None:
+            raise ImportError('Incremental decoding requires ijson')
+        with gzip.GzipFile(filename, 'r') as fin:
+            yield from ijson.kvitems(fin, 'resources', use_float=True)
+    else:
+        page = read_gzip_json(filename)
+        yield from page['resources'].items()
+
+def mark_scrape_done(output_dir, **info):
+    """Mark a scraping session as done, so that processes reading pages
+    while they are being scraped know that no more pages will follow"""
+    with open(os.path.join(output_dir, SCRAPE_DONE_FN), 'w') as handle:
+        json.dump(info, handle)
+
+def clear_scrape_done(output_dir):
+    """Remove the mark of a previous scrape, e.g. when a scraping session is
+    restarted"""
+    done_fn = os.path.join(output_dir, SCRAPE_DONE_FN)
+    if os.path.exists(done_fn):
+        os.remove(done_fn)
+
+def is_scrape_done(output_dir):
+    return os.path.exists(os.path.join(output_dir, SCRAPE_DONE_FN))
@@ -0,0 +1,231 @@
+"""
+Lightweight instrumentation for the scraper and the corpus generator.
+
+Stages (e.g. reading the resources or extracting a table) and HTTP requests
+are recorded as JSON objects, one per line, in a metrics file. At the end of
+a run, a summary with per-stage durations, memory usage and request latency
+statistics is appended to the same file and written to the log.
+"""
+import os
+import sys
+import math
+import json
+import time
+import logging
+import warnings
+import cProfile
+import datetime
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # The resource module is not available on Windows
+    resource = None
+
+# Upper bounds (in seconds) of the request latency histogram bins. The last
+# bin collects all requests slower than the last bound.
+LATENCY_BINS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+###
+
+def peak_rss():
+    """Return the peak resident set size of the current process in bytes, or
+    None if this cannot be determined on the current platform."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS, but in kilobytes on Linux
+    if sys.platform == 'darwin':
+        return peak
+    return peak * 1024
+
+def latency_histogram(latencies, bins=LATENCY_BINS):
+    """Count the number of latencies in every bin of a histogram.
+
+    >>> latency_histogram([0.05, 0.3, 0.4, 50], bins=[0.1, 1])
+    {'<=0.1': 1, '<=1': 2, '>1': 1}
+
+    Parameters
+    ----------
+    latencies : list
+        A list of latencies in seconds
+    bins : list, optional
+        Upper bounds of the bins, by default LATENCY_BINS
+
+    Returns
+    -------
+    dict
+        The count per bin
+    """
+    histogram = {f'<={bound}': 0 for bound in bins}
+    histogram[f'>{bins[-1]}'] = 0
+    for latency in latencies:
+        for bound in bins:
+            if latency <= bound:
+                histogram[f'<={bound}'] += 1
+                break
+        else:
+            histogram[f'>{bins[-1]}'] += 1
+    return histogram
+
+def percentile(values, q):
+    """Return the q-th percentile (0-100) of a list of values, using the
+    nearest-rank method.
+
+    >>> percentile([1, 2, 3, 4], 50)
+    2
+    >>> percentile([], 50)
+    """
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    rank = max(math.ceil(q / 100 * len(ordered)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+###
+
+class Metrics(object):
+
+    def __init__(self, filename=None, profile_stage=None, profile_dir=None):
+        """Collects metrics about pipeline stages and HTTP requests.
+
+        Parameters
+        ----------
+        filename : str or None, optional
+            The JSON-lines file to which all records are written. If None
+            (the default), records are only kept in memory.
+        profile_stage : str or None, optional
+            The name of a stage to run under cProfile, by default None. The
+            profile is stored as `profile-{stage}.prof` in `profile_dir`.
+        profile_dir : str or None, optional
+            Directory for profiles, by default the directory of `filename`
+            or the current working directory.
+        """
+        self.filename = filename
+        self.profile_stage = profile_stage
+        if profile_dir is None:
+            profile_dir = os.path.dirname(filename) if filename else os.getcwd()
+        self.profile_dir = profile_dir
+        self.stages = []
+        self.requests = []
+        if filename is not None:
+            # Start with an empty file
+            open(filename, 'w').close()
+
+    def emit(self, record):
+        """Write a single record to the metrics file"""
+        record = dict(record, time=datetime.datetime.now().isoformat())
+        if self.filename is not None:
+            with open(self.filename, 'a') as handle:
+                handle.write(json.dumps(record) + '\n')
+        return record
+
+    @contextmanager
+    def stage(self, name, rows_in=None, **extra):
+        """Context manager that measures a pipeline stage. The yielded record
+        is a dictionary to which the stage can add information, most notably
+        `rows_out`.
+
+        >>> metrics = Metrics()
+        >>> with metrics.stage('double', rows_in=2) as record:
+        ...     record['rows_out'] = 4
+        >>> metrics.stages[0]['rows_out']
+        4
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage
+        rows_in : int or None, optional
+            The number of rows the stage starts with, by default None
+        **extra
+            Further fields stored in the record
+        """
+        record = dict(kind='stage', stage=name, rows_in=rows_in, rows_out=None)
+        record.update(extra)
+        profiler = None
+        if name == self.profile_stage:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        rss_start = peak_rss()
+        t0 = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['duration'] = time.perf_counter() - t0
+            record['peak_rss'] = peak_rss()
+            if rss_start is not None:
+                record['peak_rss_increase'] = record['peak_rss'] - rss_start
+            if profiler is not None:
+                profiler.disable()
+                safe_name = name.replace(os.sep, '_').replace(':', '_')
+                profile_fn = os.path.join(self.profile_dir, f'profile-{safe_name}.prof')
+                profiler.dump_stats(profile_fn)
+                record['profile'] = profile_fn
+                logging.info(f'Stored profile of stage {name} to {profile_fn}')
+            self.stages.append(self.emit(record))
+
+    def record_request(self, url, duration, status=None, retries=0, error=None):
+        """Record a single HTTP request.
+
+        Parameters
+        ----------
+        url : str
+            The request url
+        duration : float
+            Latency of the request in seconds
+        status : int or None, optional
+            The HTTP status code, by default None
+        retries : int, optional
+            Number of times the request was retried, by default 0
+        error : str or None, optional
+            Description of the error, if the request failed
+        """
+        record = dict(kind='request', url=url, duration=duration,
+            status=status, retries=retries, error=error)
+        self.requests.append(self.emit(record))
+
+    def summary(self):
+        """Compute a summary of all recorded stages and requests, write it to
+        the metrics file and the log, and return it as a dictionary."""
+        stages = {}
+        for record in self.stages:
+            stages[record['stage']] = {
+                key: record.get(key) for key in
+                ['duration', 'rows_in', 'rows_out', 'peak_rss', 'peak_rss_increase']
+            }
+
+        latencies = [r['duration'] for r in self.requests]
+        requests = {
+            'count': len(self.requests),
+            'failed': sum(r['error'] is not None for r in self.requests),
+            'retries': sum(r['retries'] for r in self.requests),
+            'total_duration': sum(latencies),
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99),
+            'max': max(latencies) if latencies else None,
+            'histogram': latency_histogram(latencies),
+        }
+        summary = dict(kind='summary', stages=stages, requests=requests,
+            peak_rss=peak_rss())
+        summary = self.emit(summary)
+
+        logging.info('Metrics summary:')
+        for name, stage in stages.items():
+            rows = f"{stage['rows_in']} -> {stage['rows_out']} rows"
+            logging.info(f"* {name}: {stage['duration']:.2f}s, {rows}")
+        if requests['count'] > 0:
+            logging.info(f"* {requests['count']} requests "
+                f"({requests['failed']} failed, {requests['retries']} retries), "
+                f"median latency {requests['p50']:.3f}s, p99 {requests['p99']:.3f}s")
+        if summary['peak_rss'] is not None:
+            logging.info(f"* Peak RSS: {summary['peak_rss'] / 1024**2:.0f} MB")
+
+        if self.profile_stage is not None and self.profile_stage not in stages:
+            message = (f'Stage {self.profile_stage} was never run, so it was '
+                f'not profiled. Stages: {", ".join(stages)}')
+            logging.warning(message)
+            warnings.warn(message)
+        return summary
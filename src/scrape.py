@@ -8,7 +8,8 @@ import logging
 import os
 import math
 import datetime
-from helpers import write_gzip_json
+from helpers import write_gzip_json, mark_scrape_done, clear_scrape_done
+from instrumentation import Metrics
 
 # Disable InsecureRequestWarning, triggered by an expired SSL certificate
 # of the Abbot server.
@@ -34,7 +35,8 @@ def relpath(path, start=ROOT_DIR):
 class AbbotScraper:
 
     def __init__(self, name='scrape', endpoint=ABBOT_ENDPOINT, scrape_dir=SCRAPE_DIR,
-        request_delay=0.5, date=datetime.date.today().strftime("%Y-%m-%d")):
+        request_delay=0.5, date=datetime.date.today().strftime("%Y-%m-%d"),
+        profile_stage=None, worker=None):
         """The AbbotScraper class.
 
         The scraper can scrape the entire Cantus database. It stores all 
@@ -54,10 +56,18 @@ class AbbotScraper:
         date : string, optional
             a date string used to name the output directory. This defaults to
             today.
+        profile_stage : str or None, optional
+            Name of a stage (e.g. 'scrape') to profile using cProfile, 
+            by default None
+        worker : str or None, optional
+            Name of the worker process, if several processes scrape into the
+            same directory; see `coordinator.py`. Every worker gets its own
+            log and metrics file. By default None.
         """
         self.name = f'{date}-{name}'
         self.endpoint = endpoint
-        self.request_delay = 0.5
+        self.request_delay = request_delay
+        suffix = '' if worker is None else f'-{worker}'
 
         # Directories
         self.output_dir = os.path.join(scrape_dir, self.name)
@@ -68,7 +78,7 @@ class AbbotScraper:
             os.makedirs(self.pages_dir)
 
         # Setup logging
-        log_fn = os.path.join(self.output_dir, 'scraping.log')
+        log_fn = os.path.join(self.output_dir, f'scraping{suffix}.log')
         logging.basicConfig(
             filename=log_fn,
             filemode='w',
@@ -79,6 +89,11 @@ class AbbotScraper:
         logging.info(f'Logging to {relpath(log_fn)}')
         logging.info(f'Storing pages in {relpath(self.pages_dir)}')
 
+        # Metrics on requests and pages are stored as JSON lines
+        metrics_fn = os.path.join(self.output_dir, f'metrics{suffix}.jsonl')
+        self.metrics = Metrics(metrics_fn, profile_stage=profile_stage)
+        logging.info(f'Storing metrics in {relpath(metrics_fn)}')
+
         # Connect to the Abbot API
         # Verify is false because the Abbot ssh certificate has expired (07-2020)
         self.request_params = dict(verify=False)
@@ -105,8 +120,17 @@ class AbbotScraper:
         for key, value in self.request_params.items():
             if key not in kwargs:
                 kwargs[key] = value
-        response = requests.get(url, **kwargs)
-        response.raise_for_status()
+        t0 = time.perf_counter()
+        try:
+            response = requests.get(url, **kwargs)
+            response.raise_for_status()
+        except Exception as e:
+            status = getattr(getattr(e, 'response', None), 'status_code', None)
+            self.metrics.record_request(url, time.perf_counter() - t0,
+                status=status, error=repr(e))
+            raise
+        self.metrics.record_request(url, time.perf_counter() - t0,
+            status=response.status_code)
         time.sleep(self.request_delay)
         return response
 
@@ -138,10 +162,11 @@ class AbbotScraper:
         page_size : int, optional
             The number of resources per page, by default 100 (the maximum)
         """
-        
+        # The session may be restarted: it is not done until all pages are in
+        clear_scrape_done(self.output_dir)
+
         # First request to get the number of pages
-        response = self.get(self.request_url)
-        num_results = int(response.headers['X-Cantus-Total-Results'])
+        num_results = self.get_num_results()
         num_pages = math.ceil(num_results / page_size)
         if end_page == -1: end_page = num_pages
         logging.info(f'Scraping...')
@@ -153,20 +178,61 @@ class AbbotScraper:
 
         durations = []
         pages = range(start_page, end_page + 1)
-        for i, page_num in enumerate(pages):
-            t0 = time.time()
-            page = self.get_page(page_num, page_size=page_size)
-            page_fn = os.path.join(self.pages_dir, f'page-{page_num:04d}.json.gz')
-            write_gzip_json(page_fn, page)
-            durations.append(time.time() - t0)
-            
-            # Report progress: pages left and expected remaining time
-            durations = durations[-50:]
-            avg_duration = sum(durations) / len(durations)
-            seconds = round((end_page - page_num) * avg_duration)
-            remaining = str(datetime.timedelta(seconds=seconds))
-            print(f'Page {page_num:04d}/{end_page} done. Time remaining: {remaining}',
-                end='\r')
+        with self.metrics.stage('scrape', rows_in=len(pages)) as stage:
+            num_resources = 0
+            for i, page_num in enumerate(pages):
+                t0 = time.time()
+                page = self.scrape_page(page_num, page_size=page_size)
+                num_resources += len(page['resources'])
+                durations.append(time.time() - t0)
+
+                # Report progress: pages left and expected remaining time
+                durations = durations[-50:]
+                avg_duration = sum(durations) / len(durations)
+                seconds = round((end_page - page_num) * avg_duration)
+                remaining = str(datetime.timedelta(seconds=seconds))
+                print(f'Page {page_num:04d}/{end_page} done. Time remaining: {remaining}',
+                    end='\r')
+            stage['rows_out'] = num_resources
+        mark_scrape_done(self.output_dir, start_page=start_page, end_page=end_page)
+        self.metrics.summary()
+
+    def get_num_results(self):
+        """Return the total number of resources in the Cantus database"""
+        response = self.get(self.request_url)
+        return int(response.headers['X-Cantus-Total-Results'])
+
+    def scrape_page(self, page_num, page_size, pages_dir=None):
+        """Retrieve a single page and store it as a gzipped JSON file
+
+        Parameters
+        ----------
+        page_num : int
+            The page number
+        page_size : int
+            The page size
+        pages_dir : str or None, optional
+            Directory where the page is stored, by default the pages 
+            directory of the scraper
+
+        Returns
+        -------
+        dict
+            The page, see `get_page`
+        """
+        t0 = time.perf_counter()
+        page = self.get_page(page_num, page_size=page_size)
+        if pages_dir is None:
+            pages_dir = self.pages_dir
+        page_fn = os.path.join(pages_dir, f'page-{page_num:04d}.json.gz')
+        # Write to a temporary file first, so that processes watching the 
+        # pages directory never read a partially written page
+        write_gzip_json(f'{page_fn}.tmp', page)
+        os.replace(f'{page_fn}.tmp', page_fn)
+        self.metrics.emit(dict(kind='page', page=page_num, 
+            resources=len(page['resources']), complete=page['complete'],
+            duration=time.perf_counter() - t0))
+        return page
 
     def get_page(self, page, page_size):
         """Retrieve the resources on a given page